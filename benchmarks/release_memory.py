@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+# Memory used by get_mod_infos() results on a synthetic set of mods, measured with tracemalloc.
+# No network is used, the mod portal answers are generated and served by a fake requests.get().
+#
+# Usage : python benchmarks/release_memory.py [--mods 1000] [--releases 40] [--raw]
+#   --raw keeps the raw "releases" JSON of each mod instead, as it was done before the Release records.
+
+from __future__ import print_function
+import argparse
+import os
+import random
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+import mods_manager  # noqa: E402
+from packaging.version import parse  # noqa: E402
+
+
+def make_payload(mod_index, releases_count):
+    releases = []
+    for i in range(releases_count):
+        version = '1.%d.%d' % (i // 10, i % 10)
+        releases.append({
+            'version': version,
+            'released_at': '20%02d-%02d-%02dT10:00:00.000000Z' % (10 + i // 12, i % 12 + 1, i % 27 + 1),
+            'file_name': 'mod%d_%s.zip' % (mod_index, version),
+            'sha1': '%040x' % random.getrandbits(160),
+            'download_url': '/download/mod%d/%x' % (mod_index, random.getrandbits(48)),
+            'info_json': {
+                'name': 'mod%d' % mod_index,
+                'version': version,
+                'title': 'Synthetic mod %d' % mod_index,
+                'author': 'author%d' % mod_index,
+                'description': ('Release %s of the synthetic mod %d. ' % (version, mod_index)) * 20,
+                'factorio_version': '1.1' if i < releases_count // 2 else '2.0',
+                'dependencies': ['base >= 1.1', 'lib%d >= 1.%d' % (mod_index % 50, i // 10), '? other%d' % (mod_index % 30)]
+            }
+        })
+
+    return {
+        'name': 'mod%d' % mod_index,
+        'releases': releases,
+        'changelog': 'Changelog of mod %d\n' % mod_index * 500
+    }
+
+
+class FakeResponse(object):
+    status_code = 200
+
+    def __init__(self, payload):
+        self.payload = payload
+
+    def json(self):
+        return self.payload
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Memory used by get_mod_infos() on synthetic mods")
+    parser.add_argument('--mods', type=int, default=1000)
+    parser.add_argument('--releases', type=int, default=40)
+    parser.add_argument('--raw', action='store_true', help="Keep the raw releases JSON instead of the Release records.")
+    args = parser.parse_args()
+
+    random.seed(1)
+    mods_manager.glob['factorio_version'] = parse('2.0')
+    mods_manager.requests.get = lambda url, **kwargs: FakeResponse(make_payload(int(url.split('/')[-2][3:]), args.releases))
+
+    tracemalloc.start()
+    held = []
+    for mod_index in range(args.mods):
+        mod = {'name': 'mod%d' % mod_index, 'enabled': True}
+        if args.raw:
+            held.append(mods_manager.requests.get('/mod%d/full' % mod_index).json()['releases'])
+        else:
+            held.append(mods_manager.get_mod_infos(mod))
+
+    held_size, peak_size = tracemalloc.get_traced_memory()
+    del held
+    left_size = tracemalloc.get_traced_memory()[0]
+
+    print('%d mods x %d releases (%s) : held %.1f MiB, peak %.1f MiB, left after release %.1f MiB' % (
+        args.mods,
+        args.releases,
+        'raw JSON' if args.raw else 'Release records',
+        held_size / 1048576.0,
+        peak_size / 1048576.0,
+        left_size / 1048576.0
+    ))
+
+
+if __name__ == '__main__':
+    main()
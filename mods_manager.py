@@ -10,6 +10,14 @@ import argparse
 import subprocess
 import re
 import copy
+import shutil
+import time
+import atexit
+import cProfile
+import pstats
+import difflib
+import zipfile
+import zlib
 from datetime import datetime
 from packaging.version import parse
 
@@ -37,6 +45,10 @@ glob = {
     'should_reload': False,
     'service_name': None,
     'has_to_reload': None,
+    'staged_update': False,
+    'staging_folder_path': None,
+    'previous_folder_path': None,
+    'live_mods_folder_path': None,
     'should_downgrade': False,
     'install_required_dependencies': True,
     'install_optional_dependencies': False,
@@ -44,13 +56,29 @@ glob = {
     'remove_optional_dependencies': False,
     'ignore_conflicts_dependencies': False,
     'alternative_glibc_directory': False,
-    'alternative_glibc_version': False
+    'alternative_glibc_version': False,
+    'profile_path': None,
+    'profile_memory': False,
+    'profile_top': 20,
+    'index_path': os.path.join(__location__, 'mods-index.json'),
+    'index_max_age': 24 * 3600,
+    'index_full_rebuild_age': 30 * 24 * 3600,
+    'index_fresh_age': 3600,
+    'index_page_size': 500,
+    'portal_walk_max_pages': 10,
+    'full_update': False,
+    'update_cursor_path': None,
+    'update_cursor_max_age': 7 * 24 * 3600,
+    'pending_update_cursor': None,
+    'verify_workers': None,
+    'request_timeout': (10, 60)
 }
 
 
 # Global, utility functions
 def get_file_sha1(file_name):
-    blocksize = 65536
+    # hashlib releases the GIL on big buffers, which lets --verify hash several files at once
+    blocksize = 1048576
     hasher = hashlib.sha1()
     with open(file_name, 'rb') as afile:
         buf = afile.read(blocksize)
@@ -86,6 +114,14 @@ group = parser.add_argument_group('Mod listing')
 group.add_argument('-l', '--list', action='store_true', dest='list_mods',
                    help="List installed mods and return. Ignore other switches.")
 
+group = parser.add_argument_group('Mod search')
+group.add_argument('--search', dest='search_text',
+                   help="Search the mod portal by (part of) name or title and return. Use a local index of the portal,\n"
+                        "built on first use and refreshed once a day. Ignore other switches.")
+
+group.add_argument('--refresh-index', action='store_true', dest='refresh_index',
+                   help="Refresh the local index of the mod portal now, even if it is less than a day old.")
+
 group = parser.add_argument_group('Mod installation')
 group.add_argument('-i', '--install', dest='mod_name_to_install',
                    help="Install the given mod. See README to easily find the correct mod name.")
@@ -94,6 +130,9 @@ group = parser.add_argument_group('Mod update')
 group.add_argument('-U', '--update', action='store_true', dest='should_update',
                    help="Enable the update process. By default, all mods are updated. See -e/--update-enabled-only.")
 
+group.add_argument('--full-update', action='store_true', dest='full_update',
+                   help="Check every installed mod against the portal, instead of only the ones updated since the last run.")
+
 group.add_argument('-e', '--update-enabled-only', action='store_true', dest='enabled_only',
                    help="Will only updates mods 'enabled' in 'mod-list.json'.")
 
@@ -101,6 +140,17 @@ group = parser.add_argument_group('Mod removal')
 group.add_argument('-r', '--remove', dest='remove_mod_name',
                    help="Remove specified mod.")
 
+group = parser.add_argument_group('Mod verification')
+group.add_argument('--verify', action='store_true', dest='verify',
+                   help="Check every installed mod file against its SHA1 from the portal, its zip structure and its info.json.\n"
+                        "Exit with an error code if any problem is found. Ignore other switches.")
+
+group.add_argument('--repair', action='store_true', dest='repair',
+                   help="Same as --verify, but re-download the corrupted or missing mods.")
+
+group.add_argument('--verify-workers', type=int, dest='verify_workers',
+                   help="Number of mod files verified at once (override config.json). Default to the number of CPU cores.")
+
 group = parser.add_argument_group('Mod enabling / disabling')
 group.add_argument('-E', '--enable', dest='enable_mods_name', action='append',
                    help="A mod name to enable. Repeat the flag for each mod you want to enable.")
@@ -115,6 +165,14 @@ group.add_argument('--reload', action='store_true', dest='should_reload',
 group.add_argument('-s', '--service-name', dest='service_name',
                    help="The service name used to launch Factorio. Do not pass anything if not the case (prevent reloading).")
 
+group = parser.add_argument_group('Staged update (override config.json)')
+group.add_argument('--staged', action='store_true', dest='staged_update',
+                   help="Download and verify everything in a staging folder while Factorio keeps running, then swap it\n"
+                        "with the live mods folder right before the restart. The previous folder is kept for --rollback.")
+
+group.add_argument('--rollback', action='store_true', dest='rollback',
+                   help="Swap back the mods folder kept by the last staged update and restart Factorio if enabled. Ignore other switches.")
+
 group = parser.add_argument_group('Dependencies management (override config.json)')
 group.add_argument('-nrd', '--no-required-dependencies', action='store_true', dest='disable_required_dependencies',
                    help="Disable the auto-installation of REQUIRED dependencies.")
@@ -138,6 +196,18 @@ group.add_argument('--alternative-glibc-directory', dest='alt_glibc_dir',
 group.add_argument('--alternative-glibc-version', dest='alt_glibc_version',
                    help="Version of the alternative GLIBC library.")
 
+group = parser.add_argument_group('Profiling')
+group.add_argument('--profile', dest='profile_path',
+                   help="Profile each operation with cProfile. Write the pstats file to the given path and a\n"
+                        "top functions summary per operation next to it (same path with a '.txt' suffix).")
+
+group.add_argument('--profile-memory', action='store_true', dest='profile_memory',
+                   help="With --profile, also take a tracemalloc snapshot after each operation and add the top allocations to the summary.\n"
+                        "Require Python 3.4 or newer.")
+
+group.add_argument('--profile-top', type=int, dest='profile_top', default=glob['profile_top'],
+                   help="Number of entries shown per operation in the profile summary. Default to %d." % glob['profile_top'])
+
 group = parser.add_argument_group('Self Updating')
 group.add_argument('--update-mod-manager', action='store_true', dest='update_mod_manager',
                    help="Update Factorio-mod-manager. Require GIT. Program will exit after, this flag should be used alone.")
@@ -241,6 +311,147 @@ def remove_file(file_path):
         os.remove(file_path)
 
 
+def copy_owner(src, dst):
+    # Mostly useful when run as root : the staging folder becomes the live one, Factorio must still own it
+    if not hasattr(os, 'chown'):
+        return
+
+    stat = os.stat(src)
+    try:
+        os.chown(dst, stat.st_uid, stat.st_gid)
+    except OSError as e:
+        debug('Cannot give %s the owner of %s : %s' % (dst, src, e))
+
+
+def stage_copy_file(src, dst):
+    # Mods zip files are never written in place (see download_mod), so a hard link is enough and keeps the staging
+    # almost free. Everything else (mod-list.json, mod-settings.dat...) is really copied as it may be rewritten.
+    if src.endswith('.zip'):
+        try:
+            os.link(src, dst)
+            return
+        except OSError:
+            pass
+
+    shutil.copy2(src, dst)
+    copy_owner(src, dst)
+
+
+def copy_mods_folder(src, dst):
+    # Same as shutil.copytree(symlinks=True, copy_function=stage_copy_file), which Python 2 does not have
+    copied_folders = []
+    for root, dirs, files in os.walk(src):
+        dst_root = os.path.join(dst, os.path.relpath(root, src))
+        os.makedirs(dst_root)
+        copied_folders.append((root, dst_root))
+
+        for name in files + [directory for directory in dirs if os.path.islink(os.path.join(root, directory))]:
+            src_path = os.path.join(root, name)
+            if os.path.islink(src_path):
+                os.symlink(os.readlink(src_path), os.path.join(dst_root, name))
+            else:
+                stage_copy_file(src_path, os.path.join(dst_root, name))
+
+    # Like copytree, mode and times are copied once the content is written, a read-only folder would block it before
+    for root, dst_root in reversed(copied_folders):
+        shutil.copystat(root, dst_root)
+        copy_owner(root, dst_root)
+
+
+def prepare_staging():
+    debug('Preparing staging folder %s' % glob['staging_folder_path'])
+
+    # A leftover staging folder comes from an aborted run, never trust it
+    if os.path.isdir(glob['staging_folder_path']):
+        shutil.rmtree(glob['staging_folder_path'])
+
+    copy_mods_folder(glob['live_mods_folder_path'], glob['staging_folder_path'])
+
+    # From now on, every file operation happens in the staging folder while Factorio keeps running
+    glob['mods_folder_path'] = glob['staging_folder_path']
+    glob['mods_list_path'] = os.path.join(glob['staging_folder_path'], 'mod-list.json')
+
+
+def restore_live_paths():
+    glob['mods_folder_path'] = glob['live_mods_folder_path']
+    glob['mods_list_path'] = os.path.join(glob['live_mods_folder_path'], 'mod-list.json')
+
+
+def commit_staging():
+    debug('Swapping staging folder %s with %s' % (glob['staging_folder_path'], glob['live_mods_folder_path']))
+    start = time.time()
+
+    if os.path.isdir(glob['previous_folder_path']):
+        shutil.rmtree(glob['previous_folder_path'])
+
+    try:
+        os.rename(glob['live_mods_folder_path'], glob['previous_folder_path'])
+        try:
+            os.rename(glob['staging_folder_path'], glob['live_mods_folder_path'])
+        except OSError:
+            # Put the live folder back, the staging folder is left as is for inspection
+            os.rename(glob['previous_folder_path'], glob['live_mods_folder_path'])
+            raise
+    except OSError as e:
+        print('Error while swapping the staging folder with the mods folder : %s' % e)
+        print('The mods folder has not been modified. Aborting the mission...')
+        exit(1)
+
+    restore_live_paths()
+    debug('Staging folder swapped in %.3f seconds, previous mods kept in %s' % (time.time() - start, glob['previous_folder_path']))
+
+
+def discard_staging():
+    debug('Nothing changed, removing staging folder %s' % glob['staging_folder_path'])
+    shutil.rmtree(glob['staging_folder_path'], ignore_errors=True)
+    restore_live_paths()
+
+
+def rollback_mods():
+    if not os.path.isdir(glob['previous_folder_path']):
+        print('No previous mods folder found in %s, nothing to roll back !' % glob['previous_folder_path'])
+        return False
+
+    if glob['dry_run']:
+        print('Dry-running, would have swapped %s with %s' % (glob['previous_folder_path'], glob['live_mods_folder_path']))
+        return True
+
+    print('Rolling back to the mods folder %s' % glob['previous_folder_path'])
+    if os.path.isdir(glob['staging_folder_path']):
+        shutil.rmtree(glob['staging_folder_path'])
+
+    # The current mods become the "previous" ones, so a rollback can itself be rolled back
+    renames = [
+        (glob['live_mods_folder_path'], glob['staging_folder_path']),
+        (glob['previous_folder_path'], glob['live_mods_folder_path']),
+        (glob['staging_folder_path'], glob['previous_folder_path'])
+    ]
+    done_renames = []
+    try:
+        for src, dst in renames:
+            os.rename(src, dst)
+            done_renames.append((src, dst))
+    except OSError as e:
+        print('Error while rolling back the mods folder : %s' % e)
+        # Undo the renames already done, in reverse order, so the mods folder is always where Factorio expects it
+        try:
+            for src, dst in reversed(done_renames):
+                os.rename(dst, src)
+        except OSError as e:
+            print('Error while restoring the mods folder : %s' % e)
+            print('Please check the folders %s, %s and %s by yourself !' % (
+                glob['live_mods_folder_path'],
+                glob['previous_folder_path'],
+                glob['staging_folder_path']
+            ))
+            exit(1)
+        print('The mods folder has not been modified. Aborting the mission...')
+        exit(1)
+
+    glob['has_to_reload'] = True
+    return True
+
+
 def display_mods_list(mods_list):
     if len(mods_list) == 0:
         print('No mods are installed')
@@ -253,11 +464,52 @@ def display_mods_list(mods_list):
 """ % (mod['name'], mod['enabled']))
 
 
+def parse_portal_date(value):
+    # The portal usually sends microseconds, but not always
+    for date_format in ('%Y-%m-%dT%H:%M:%S.%fZ', '%Y-%m-%dT%H:%M:%SZ'):
+        try:
+            return datetime.strptime(value, date_format)
+        except ValueError:
+            pass
+
+    return datetime.min
+
+
+# Parsed Factorio versions are shared by every release. There is only a handful of them, so this never grows.
+glob_factorio_versions_cache = {}
+
+
+class Release(object):
+    # Compact projection of a portal release. The raw "/full" payload (info_json, changelog...) is large and only
+    # these fields are ever used, so we keep them alone and let the payload be garbage collected.
+    __slots__ = ('version', 'factorio_version', 'released_at', 'file_name', 'sha1', 'download_url', 'dependencies')
+
+    def __init__(self, release_json, dependencies_cache):
+        info_json = release_json.get('info_json', {})
+
+        factorio_version = info_json.get('factorio_version', '0.0')
+        if factorio_version not in glob_factorio_versions_cache:
+            glob_factorio_versions_cache[factorio_version] = parse(factorio_version)
+
+        # Releases of the same mod often share the same dependencies, the caller gives a cache local to the mod
+        dependencies = tuple(info_json.get('dependencies', []))
+        if dependencies not in dependencies_cache:
+            dependencies_cache[dependencies] = parse_dependencies(dependencies)
+
+        self.version = release_json['version']
+        self.factorio_version = glob_factorio_versions_cache[factorio_version]
+        self.released_at = parse_portal_date(release_json['released_at'])
+        self.file_name = release_json['file_name']
+        self.sha1 = release_json['sha1']
+        self.download_url = release_json['download_url']
+        self.dependencies = dependencies_cache[dependencies]
+
+
 def get_mod_infos(mod, min_mod_version='latest'):
     debug('Getting mod "%s" infos...' % (mod['name']))
     request_url = 'https://mods.factorio.com/api/mods/' + mod['name'] + '/full'
 
-    r = requests.get(request_url)
+    r = requests.get(request_url, timeout=glob['request_timeout'])
     if r.status_code != 200:
         print('Error getting mod "' + mod['name'] + '" infos. Ignoring this mod, please, check your "mod-list.json" file.')
         return False
@@ -268,16 +520,21 @@ def get_mod_infos(mod, min_mod_version='latest'):
         debug('Mod "%s" does not seems to have any release ! Skipping...' % (mod['name']))
         return False
 
-    sorted_releases = sorted(json_result['releases'], key=lambda i: datetime.strptime(i['released_at'], '%Y-%m-%dT%H:%M:%S.%fZ'), reverse=True)
+    dependencies_cache = {}
+    releases = [Release(release, dependencies_cache) for release in json_result['releases']]
+    # Drop the raw payload right away, only the compact releases are kept
+    del json_result, r
+
+    sorted_releases = sorted(releases, key=lambda i: i.released_at, reverse=True)
 
     if min_mod_version == 'latest':
         if glob['should_downgrade'] is True:
-            filtered_releases = [release for release in sorted_releases if parse(release['info_json']['factorio_version']) <= glob['factorio_version']]
+            filtered_releases = [release for release in sorted_releases if release.factorio_version <= glob['factorio_version']]
         else:
-            filtered_releases = [release for release in sorted_releases if parse(release['info_json']['factorio_version']) == glob['factorio_version']]
+            filtered_releases = [release for release in sorted_releases if release.factorio_version == glob['factorio_version']]
 
     else:
-        filtered_releases = [release for release in sorted_releases if parse(release['version']) >= parse(min_mod_version)]
+        filtered_releases = [release for release in sorted_releases if parse(release.version) >= parse(min_mod_version)]
 
         if len(filtered_releases) == 0:
             print('Asked for mod "%s" at least version "%s" but no result found ! Skipping...' % (
@@ -296,6 +553,227 @@ def get_mod_infos(mod, min_mod_version='latest'):
     return mods_infos
 
 
+def get_portal_mods_page(page, page_size, sort='name', sort_order='asc'):
+    debug('Getting page %s of the mod portal listing...' % page)
+    params = {'page': page, 'page_size': page_size, 'sort': sort, 'sort_order': sort_order}
+
+    r = requests.get('https://mods.factorio.com/api/mods', params=params)
+    if r.status_code != 200:
+        print('Error getting page %s of the mod portal listing !' % page)
+        return False
+
+    json_result = r.json()
+    if 'results' not in json_result:
+        print('Error getting page %s of the mod portal listing, there is no "results" in it !' % page)
+        return False
+
+    return json_result
+
+
+def latest_portal_date(first, second):
+    # Either can be None, a date saved earlier must never be replaced by an older one
+    if first is None or (second is not None and parse_portal_date(second) > parse_portal_date(first)):
+        return second
+
+    return first
+
+
+def get_portal_newest_updated_at():
+    # "updated_at" of the most recently updated mod, None if it cannot be known
+    json_result = get_portal_mods_page(1, 1, 'updated_at', 'desc')
+    if not json_result or len(json_result['results']) == 0:
+        return None
+
+    return json_result['results'][0].get('updated_at')
+
+
+def get_portal_mods_updated_since(last_updated_at):
+    # Walk the portal listing from the most recently updated mod, down to the first one not updated since
+    # last_updated_at. Only "updated_at", the sort key, can tell where to stop : any other date (latest release...)
+    # is not in this order and could hide updated mods further down.
+    # Return the updated mods, newest first, or False when the walk cannot be trusted (full check needed).
+    last_updated_at = parse_portal_date(last_updated_at)
+    portal_mods = []
+
+    page = 1
+    while True:
+        json_result = get_portal_mods_page(page, 100, 'updated_at', 'desc')
+        if not json_result:
+            return False
+
+        for portal_mod in json_result['results']:
+            if 'updated_at' not in portal_mod:
+                debug('Mod "%s" has no "updated_at" in the portal listing, cannot know what changed' % portal_mod.get('name'))
+                return False
+
+            if parse_portal_date(portal_mod['updated_at']) <= last_updated_at:
+                return portal_mods
+
+            portal_mods.append(portal_mod)
+
+        if page >= json_result.get('pagination', {}).get('page_count', page):
+            return portal_mods
+
+        if page >= glob['portal_walk_max_pages']:
+            debug('More than %d pages of mods updated on the portal, cannot walk them all' % glob['portal_walk_max_pages'])
+            return False
+
+        page += 1
+
+
+def load_index():
+    try:
+        with open(glob['index_path'], 'r') as fd:
+            index = json.load(fd)
+    except (FileNotFoundError, ValueError):
+        return None
+
+    if 'mods' not in index or 'updated_at' not in index:
+        return None
+
+    return index
+
+
+def save_index(index):
+    debug('Writing the mods index to %s' % glob['index_path'])
+    with open(glob['index_path'], 'w') as fd:
+        json.dump(index, fd)
+
+
+def add_to_index(index, portal_mod):
+    latest_release = portal_mod.get('latest_release') or {}
+    index['mods'][portal_mod['name']] = {
+        'title': portal_mod.get('title', ''),
+        'owner': portal_mod.get('owner', ''),
+        'factorio_version': latest_release.get('info_json', {}).get('factorio_version')
+    }
+
+
+def build_index():
+    print('Building the local index of the mod portal, this may take a while...')
+    # Taken first, so the mods updated during the build are seen again by the next refresh
+    updated_at = get_portal_newest_updated_at()
+
+    index = {'updated_at': updated_at, 'built_at': time.time(), 'refreshed_at': time.time(), 'mods': {}}
+
+    page = 1
+    while True:
+        json_result = get_portal_mods_page(page, glob['index_page_size'])
+        if not json_result:
+            return False
+
+        for portal_mod in json_result['results']:
+            add_to_index(index, portal_mod)
+
+        if page >= json_result.get('pagination', {}).get('page_count', page):
+            return index
+
+        page += 1
+
+
+def refresh_index(index):
+    # Return False when the index cannot be refreshed incrementally, it must be rebuilt then
+    if index['updated_at'] is None:
+        return False
+
+    debug('Refreshing the local index of the mod portal, last change seen at %s' % index['updated_at'])
+    portal_mods = get_portal_mods_updated_since(index['updated_at'])
+    if portal_mods is False:
+        return False
+
+    for portal_mod in portal_mods:
+        add_to_index(index, portal_mod)
+
+    if len(portal_mods) > 0:
+        index['updated_at'] = latest_portal_date(index['updated_at'], portal_mods[0]['updated_at'])
+    index['refreshed_at'] = time.time()
+
+    return index
+
+
+def get_index(force_refresh=False):
+    index = load_index()
+
+    # Incremental refreshes never drop deleted mods, so the index is rebuilt from time to time
+    if index is None or time.time() - index.get('built_at', 0) > glob['index_full_rebuild_age']:
+        index = build_index()
+    elif force_refresh or time.time() - index.get('refreshed_at', 0) > glob['index_max_age']:
+        index = refresh_index(index) or build_index()
+    else:
+        return index
+
+    if index:
+        save_index(index)
+
+    return index
+
+
+def search_index(index, text, limit=10):
+    text = text.lower()
+    lowered_names = {}
+    matches = []
+
+    for name, infos in index['mods'].items():
+        lowered_name = name.lower()
+        lowered_names[lowered_name] = name
+
+        if lowered_name == text:
+            matches.append((0, len(name), name))
+        elif lowered_name.startswith(text):
+            matches.append((1, len(name), name))
+        elif text in lowered_name:
+            matches.append((2, len(name), name))
+        elif text in (infos['title'] or '').lower():
+            matches.append((3, len(name), name))
+
+    matches.sort()
+    results = [match[2] for match in matches[:limit]]
+
+    # Fill with the closest names to catch typos
+    if len(results) < limit:
+        for lowered_name in difflib.get_close_matches(text, lowered_names.keys(), n=limit):
+            if lowered_names[lowered_name] not in results:
+                results.append(lowered_names[lowered_name])
+
+    return results[:limit]
+
+
+def display_search_results(index, names):
+    if len(names) == 0:
+        print('No mod found')
+        return
+
+    print('Found mods :')
+    for name in names:
+        print("""    Mod name : %s
+    Title    : %s
+    Owner    : %s
+    Factorio : %s
+""" % (name, index['mods'][name]['title'], index['mods'][name]['owner'], index['mods'][name]['factorio_version']))
+
+
+def check_mod_name(mod_name):
+    # Only the local index is used here, never the network. Without index, we let the portal answer.
+    index = load_index()
+    if index is None or mod_name in index['mods']:
+        return True
+
+    print('Mod "%s" not found in the local index of the mod portal.' % mod_name)
+    suggestions = search_index(index, mod_name, 5)
+    if len(suggestions) > 0:
+        print('Did you mean :')
+        for name in suggestions:
+            print('    %s (%s)' % (name, index['mods'][name]['title']))
+
+    # A mod missing from a freshly refreshed index does not exist, an older index may just not know it yet
+    if time.time() - index.get('refreshed_at', 0) <= glob['index_fresh_age']:
+        print('The index has been refreshed less than %d minutes ago, no mod has been installed !' % (glob['index_fresh_age'] // 60))
+        return False
+
+    print('It may be a new mod, asking the mod portal anyway...')
+    return True
+
+
 # Dependencies rules :
 #   "no prefix" = required (must be installed)
 #   "~"         = required but does not affect load order (must be installed)
@@ -361,37 +839,123 @@ def check_file_and_sha(file_path, sha1):
     return False
 
 
+def load_update_cursor():
+    try:
+        with open(glob['update_cursor_path'], 'r') as fd:
+            return json.load(fd)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def save_update_cursor():
+    debug('Writing the update cursor to %s' % glob['update_cursor_path'])
+    if glob['dry_run']:
+        print('Dry-running, would have writen this update cursor : %s' % json.dumps(glob['pending_update_cursor']))
+        return
+
+    with open(glob['update_cursor_path'], 'w') as fd:
+        json.dump(glob['pending_update_cursor'], fd, indent=2)
+
+
+def is_update_cursor_usable(cursor):
+    if glob['full_update'] is True:
+        debug('--full-update has been used, checking every mod...')
+        return False
+
+    if cursor is None or 'updated_at' not in cursor or 'mods' not in cursor:
+        debug('No update cursor found in %s, checking every mod...' % glob['update_cursor_path'])
+        return False
+
+    if time.time() - cursor.get('saved_at', 0) > glob['update_cursor_max_age']:
+        debug('The update cursor is too old, checking every mod...')
+        return False
+
+    # The selected releases depend on these, a change means every mod must be checked again
+    if cursor.get('factorio_version') != str(glob['factorio_version']) or cursor.get('should_downgrade') != glob['should_downgrade']:
+        debug('Factorio version or downgrade option changed since the last update, checking every mod...')
+        return False
+
+    return True
+
+
+def get_recently_updated_mods(cursor):
+    # Return the newest "updated_at" of the portal and the names of the mods updated since the last update,
+    # or the names as None when the cursor cannot be used (every mod must be checked).
+    if is_update_cursor_usable(cursor):
+        portal_mods = get_portal_mods_updated_since(cursor['updated_at'])
+        if portal_mods is not False:
+            newest_updated_at = portal_mods[0]['updated_at'] if len(portal_mods) > 0 else None
+            return latest_portal_date(cursor['updated_at'], newest_updated_at), set(portal_mod['name'] for portal_mod in portal_mods)
+
+        debug('Cannot know which mods were updated since the last update, checking every mod...')
+
+    # Every mod is checked, only the newest "updated_at" is needed for the next run
+    newest_updated_at = get_portal_newest_updated_at()
+    if newest_updated_at is not None and cursor is not None:
+        newest_updated_at = latest_portal_date(cursor.get('updated_at'), newest_updated_at)
+
+    return newest_updated_at, None
+
+
 def update_mods(enabled_only):
     debug('Starting mods update...')
 
-    mods_list = read_mods_list()
+    installed_mods_list = read_mods_list()
+
+    cursor = load_update_cursor()
+    newest_updated_at, updated_mods = get_recently_updated_mods(cursor)
 
+    # Only the mods updated since the last run, or not checked by it, have to be checked again
+    if updated_mods is None:
+        mods_list = installed_mods_list
+    else:
+        mods_list = [mod for mod in installed_mods_list if mod['name'] in updated_mods or mod['name'] not in cursor['mods']]
+        debug('%d mod(s) updated on the portal since the last update, %d installed mod(s) to check' % (len(updated_mods), len(mods_list)))
+
+    not_checked_mods = set()
     for mod in mods_list:
-        mod_infos = get_mod_infos(mod)
+        if enabled_only and mod['enabled'] is False:
+            debug('Mod %s is disable and --update-enabled-only has been used. Skipping...' % (mod['name']))
+            not_checked_mods.add(mod['name'])
+            continue
 
-        if enabled_only and mod_infos['enabled'] is False:
-            debug('Mod %s is disable and --update-enabled-only has been used. Skipping...' % (mod_infos['name']))
+        mod_infos = get_mod_infos(mod)
+        if not mod_infos:
+            not_checked_mods.add(mod['name'])
             continue
 
         if len(mod_infos['same_version_releases']) == 0:
             print('No matching version found for the mod "%s". Skipping...' % (mod['name']))
             continue
 
-        delete_list = [release for release in mod_infos['releases'] if release['file_name'] not in [mod_infos['same_version_releases'][0]['file_name']]]
+        file_path = os.path.join(glob['mods_folder_path'], mod_infos['same_version_releases'][0].file_name)
+        if not check_file_and_sha(file_path, mod_infos['same_version_releases'][0].sha1):
+            debug('Downloading mod %s' % (mod_infos['name']))
+            if not download_mod(file_path, mod_infos['same_version_releases'][0].download_url, mod_infos['same_version_releases'][0].sha1):
+                print('Mod "%s" has not been updated, keeping the installed release.' % mod['name'])
+                # Not saved in the cursor, so the next update checks it again
+                not_checked_mods.add(mod['name'])
+                continue
+
+            # Save globally that a reload of Factorio is needed in the end.
+            glob['has_to_reload'] = True
+
+        # Old releases are only removed once the new one is in place
+        delete_list = [release for release in mod_infos['releases'] if release.file_name not in [mod_infos['same_version_releases'][0].file_name]]
         for release in delete_list:
-            file_path = os.path.join(glob['mods_folder_path'], release['file_name'])
+            file_path = os.path.join(glob['mods_folder_path'], release.file_name)
             debug('Removing old release file : %s' % file_path)
             remove_file(file_path)
 
-        file_path = os.path.join(glob['mods_folder_path'], mod_infos['same_version_releases'][0]['file_name'])
-        if check_file_and_sha(file_path, mod_infos['same_version_releases'][0]['sha1']):
-            continue
-
-        debug('Downloading mod %s' % (mod_infos['name']))
-        download_mod(file_path, mod_infos['same_version_releases'][0]['download_url'])
-
-        # Save globally that a reload of Factorio is needed in the end.
-        glob['has_to_reload'] = True
+    # The cursor is only written once the new mods are in place, see main()
+    if newest_updated_at is not None:
+        glob['pending_update_cursor'] = {
+            'updated_at': newest_updated_at,
+            'saved_at': time.time(),
+            'factorio_version': str(glob['factorio_version']),
+            'should_downgrade': glob['should_downgrade'],
+            'mods': [mod['name'] for mod in installed_mods_list if mod['name'] not in not_checked_mods]
+        }
 
 
 glob_install_mod_seen = {}
@@ -424,7 +988,7 @@ def install_mod(mod_name, min_mod_version='latest', install_optional_dependencie
     target_release = mod_infos['same_version_releases'][0]
 
     # Check for dependencies if needed
-    dependencies = parse_dependencies(target_release['info_json']['dependencies'])
+    dependencies = target_release.dependencies
     # Check for conflicts
     conflict = mod_has_conflicts(dependencies['conflict'])
     if conflict is not False:
@@ -443,23 +1007,26 @@ def install_mod(mod_name, min_mod_version='latest', install_optional_dependencie
     if install_optional_dependencies is True and glob['install_optional_dependencies'] is True:
         install_dependencies(mod_name, dependencies, "optional")
 
-    # Add the mod to the global list of mods which will be written to "mod-list.json" later
-    add_to_glob_mod_list(mod)
-
     # Check if file already exists and have the same sha1
-    file_path = os.path.join(glob['mods_folder_path'], target_release['file_name'])
-    if check_file_and_sha(file_path, target_release['sha1']):
+    file_path = os.path.join(glob['mods_folder_path'], target_release.file_name)
+    if check_file_and_sha(file_path, target_release.sha1):
+        # Add the mod to the global list of mods which will be written to "mod-list.json" later
+        add_to_glob_mod_list(mod)
         return
 
     # Download the file
     debug('Downloading mod %s' % (mod_infos['name']))
-    file_path = os.path.join(glob['mods_folder_path'], target_release['file_name'])
-    download_mod(file_path, target_release['download_url'])
+    if not download_mod(file_path, target_release.download_url, target_release.sha1):
+        print('Mod "%s" has not been installed !' % mod_name)
+        return False
+
+    # Add the mod to the global list of mods which will be written to "mod-list.json" later
+    add_to_glob_mod_list(mod)
 
     print('Installed mod %s version %s for Factorio version %s' % (
         mod_name,
-        target_release['version'],
-        target_release['info_json']['factorio_version']
+        target_release.version,
+        target_release.factorio_version
     ))
 
     # Save globally that a reload of Factorio is needed in the end.
@@ -512,7 +1079,7 @@ def remove_mod(mod_name, remove_optional_dependencies=True):
     if glob['remove_required_dependencies'] is True or \
             (glob['remove_optional_dependencies'] is True and remove_optional_dependencies is True):
 
-        dependencies = parse_dependencies(target_release['info_json']['dependencies'])
+        dependencies = target_release.dependencies
         if glob['remove_required_dependencies'] is True:
             remove_dependencies(mod_name, dependencies, "required")
 
@@ -522,7 +1089,7 @@ def remove_mod(mod_name, remove_optional_dependencies=True):
 
     if mod_infos is not None and 'releases' in mod_infos:
         for release in mod_infos['releases']:
-            file_path = os.path.join(glob['mods_folder_path'], release['file_name'])
+            file_path = os.path.join(glob['mods_folder_path'], release.file_name)
             remove_file(file_path)
     else:
         debug('No releases found for the mod "%s" skipping...' % mod_name)
@@ -550,13 +1117,33 @@ def remove_dependencies(parent_name, dependencies, dependencies_type):
         remove_mod(dependency[0], False)
 
 
-def download_mod(file_path, download_url):
+def reject_download(file_path):
+    # In staged mode, nothing reached the live mods folder yet : better stop here than swap a broken mod set
+    if glob['mods_folder_path'] == glob['staging_folder_path']:
+        print('The mods folder has not been modified. Aborting the mission...')
+        exit(1)
+
+    # Never leave a broken zip where Factorio would try to load it
+    if os.path.lexists(file_path):
+        os.remove(file_path)
+
+    return False
+
+
+def download_mod(file_path, download_url, sha1=None):
     if glob['dry_run']:
         print('Dry-running, would have downloaded (hiding credentials) : %s' % ('https://mods.factorio.com' + download_url))
-        return
+        return True
 
     payload = {'username': glob['username'], 'token': glob['token']}
-    r = requests.get('https://mods.factorio.com' + download_url, params=payload, stream=True)
+    try:
+        r = requests.get('https://mods.factorio.com' + download_url, params=payload, stream=True, timeout=glob['request_timeout'])
+    except requests.exceptions.RequestException as e:
+        print('Error : Cannot download "%s" (%s) !' % (file_path, e))
+        # The previous file, if any, is still untouched
+        if glob['mods_folder_path'] == glob['staging_folder_path']:
+            return reject_download(file_path)
+        return False
 
     # the Factorio mod portal may serve downloads via a CDN, which 
     # returns 'application/octet-stream' as the Content-Type
@@ -566,23 +1153,196 @@ def download_mod(file_path, download_url):
         print('Aborting the mission...')
         exit(1)
 
-    with open(file_path, 'wb') as fd:
-        total_length = r.headers.get('content-length')
-        if total_length is None:  # no content length header
-            fd.write(r.content)
-        else:
-            dl = 0
-            total_length = int(total_length)
-            for chunk in r.iter_content(8192):
-                dl += len(chunk)
-                fd.write(chunk)
-                done = int(50 * dl / total_length)
-                sys.stdout.write("\r[%s%s]" % ('=' * done, ' ' * (50 - done)))
-                sys.stdout.flush()
+    # Never write into an existing file : in staged mode it may be a hard link to the live mod
+    if os.path.lexists(file_path):
+        os.remove(file_path)
+
+    try:
+        with open(file_path, 'wb') as fd:
+            total_length = r.headers.get('content-length')
+            if total_length is None:  # no content length header
+                fd.write(r.content)
+            else:
+                dl = 0
+                total_length = int(total_length)
+                for chunk in r.iter_content(8192):
+                    dl += len(chunk)
+                    fd.write(chunk)
+                    done = int(50 * dl / total_length)
+                    sys.stdout.write("\r[%s%s]" % ('=' * done, ' ' * (50 - done)))
+                    sys.stdout.flush()
+            print()
+    except requests.exceptions.RequestException as e:
         print()
+        print('Error : The download of "%s" has been interrupted (%s) !' % (file_path, e))
+        return reject_download(file_path)
+
     # We ensure all users can read the file (dirty fix case run as root...)
     os.chmod(file_path, 0o644)
 
+    if sha1 is not None and get_file_sha1(file_path) != sha1:
+        print('Error : The downloaded file "%s" does not match its SHA1 !' % file_path)
+        return reject_download(file_path)
+
+    return True
+
+
+def get_portal_releases(mods_names):
+    # The portal returns the releases of many mods at once with "namelist", much faster than one request per mod
+    releases = {}
+    for i in range(0, len(mods_names), 100):
+        debug('Getting releases of mods %s' % mods_names[i:i + 100])
+        params = {'namelist': mods_names[i:i + 100], 'page_size': 'max'}
+        try:
+            r = requests.get('https://mods.factorio.com/api/mods', params=params, timeout=glob['request_timeout'])
+        except requests.exceptions.RequestException as e:
+            print('Error getting the releases of the installed mods (%s), SHA1 will not be checked !' % e)
+            return False
+
+        if r.status_code != 200:
+            print('Error getting the releases of the installed mods, SHA1 will not be checked !')
+            return False
+
+        for portal_mod in r.json().get('results', []):
+            dependencies_cache = {}
+            releases[portal_mod['name']] = [Release(release, dependencies_cache) for release in portal_mod.get('releases', [])]
+
+    return releases
+
+
+def verify_mod_file(mod_name, file_path, expected_sha1):
+    # Return the list of problems found, empty if the file is fine
+    problems = []
+    try:
+        if expected_sha1 is not None and get_file_sha1(file_path) != expected_sha1:
+            problems.append('SHA1 does not match the one from the portal')
+
+        with zipfile.ZipFile(file_path) as zip_file:
+            # info.json is in the only root folder of the zip
+            info_json_paths = [path for path in zip_file.namelist() if path.count('/') == 1 and path.endswith('/info.json')]
+            if len(info_json_paths) == 0:
+                problems.append('no info.json found')
+            else:
+                info_json = json.loads(zip_file.read(info_json_paths[0]).decode('utf-8-sig'))
+                if info_json.get('name') != mod_name:
+                    problems.append('info.json is for the mod "%s"' % info_json.get('name'))
+                if not os.path.basename(file_path).endswith('_%s.zip' % info_json.get('version')):
+                    problems.append('info.json is for the version "%s"' % info_json.get('version'))
+
+            # Without SHA1, reading every entry is the only way to find corrupted data
+            if expected_sha1 is None:
+                corrupted_file = zip_file.testzip()
+                if corrupted_file is not None:
+                    problems.append('"%s" is corrupted in the zip' % corrupted_file)
+    except (IOError, zipfile.BadZipfile, zlib.error, ValueError) as e:
+        problems.append('cannot be read (%s)' % e)
+
+    return problems
+
+
+def verify_mods(repair):
+    print('Verifying installed mods...')
+    start = time.time()
+
+    mods_list = read_mods_list()
+    portal_releases = get_portal_releases([mod['name'] for mod in mods_list])
+    portal_reachable = portal_releases is not False
+    portal_releases = portal_releases or {}
+
+    mods_files = {}
+    for file_name in os.listdir(glob['mods_folder_path']):
+        # Unpacked mods (folders) are listed too, there is just nothing to verify for them
+        match = re.match(r'^(.+?)(_\d+\.\d+\.\d+)?(\.zip)?$', file_name)
+        mods_files.setdefault(match.group(1), []).append(file_name if match.group(3) else None)
+
+    checks = []
+    missing_mods = []
+    for mod in mods_list:
+        if mod['name'] not in mods_files:
+            # Factorio simply ignore a disabled mod without file
+            if mod['enabled']:
+                missing_mods.append(mod)
+            continue
+
+        # A file unknown to the portal (removed release, local mod...) is still checked, except its SHA1
+        releases = dict((release.file_name, release) for release in portal_releases.get(mod['name'], []))
+        for file_name in mods_files[mod['name']]:
+            if file_name is not None:
+                checks.append((mod, file_name, releases.get(file_name)))
+
+    def verify_check(check):
+        return verify_mod_file(
+            check[0]['name'],
+            os.path.join(glob['mods_folder_path'], check[1]),
+            check[2].sha1 if check[2] is not None else None
+        )
+
+    # Imported here as concurrent.futures does not exist on Python 2, files are then verified one by one
+    try:
+        from concurrent.futures import ThreadPoolExecutor
+    except ImportError:
+        results = [verify_check(check) for check in checks]
+    else:
+        import multiprocessing
+        with ThreadPoolExecutor(max_workers=glob['verify_workers'] or multiprocessing.cpu_count()) as executor:
+            results = list(executor.map(verify_check, checks))
+
+    problems_count = len(missing_mods)
+    for mod in missing_mods:
+        print('Mod "%s" is enabled but no file has been found for it' % mod['name'])
+        if repair and install_missing_mod(mod):
+            problems_count -= 1
+
+    for check, problems in zip(checks, results):
+        if len(problems) == 0:
+            continue
+
+        problems_count += 1
+        print('Mod file "%s" : %s' % (check[1], ', '.join(problems)))
+        if repair and repair_mod_file(check[1], check[2], portal_reachable):
+            problems_count -= 1
+
+    print('Verified %d mod file(s) in %.2f seconds, %d problem(s) %s' % (
+        len(checks),
+        time.time() - start,
+        problems_count,
+        'left' if repair else 'found'
+    ))
+
+    return problems_count == 0
+
+
+def repair_mod_file(file_name, release, portal_reachable):
+    if not portal_reachable:
+        print('    The mod portal cannot be reached, it cannot be repaired !')
+        return False
+
+    if release is None:
+        print('    This file is unknown to the mod portal, it cannot be repaired !')
+        return False
+
+    print('    Downloading it again...')
+    file_path = os.path.join(glob['mods_folder_path'], file_name)
+    # download_mod() already reports a SHA1 mismatch
+    return download_mod(file_path, release.download_url, release.sha1)
+
+
+def install_missing_mod(mod):
+    try:
+        mod_infos = get_mod_infos(mod)
+    except requests.exceptions.RequestException as e:
+        print('    Cannot reach the mod portal (%s), it cannot be repaired !' % e)
+        return False
+
+    if not mod_infos or len(mod_infos['same_version_releases']) == 0:
+        print('    No matching version found for the mod "%s", it cannot be repaired !' % mod['name'])
+        return False
+
+    print('    Downloading it...')
+    target_release = mod_infos['same_version_releases'][0]
+    # download_mod() already reports a SHA1 mismatch
+    return download_mod(os.path.join(glob['mods_folder_path'], target_release.file_name), target_release.download_url, target_release.sha1)
+
 
 def update_state_mods(mods_name_list, should_enable):
     print('%s mod(s) %s' % ('Enabling' if should_enable else 'Disabling', mods_name_list))
@@ -658,6 +1418,22 @@ def load_config(args):
         print('Factorio mod list file cannot be found in %s' % (glob['mods_list_path']))
         return False
 
+    # Verification related
+    glob['verify_workers'] = args.verify_workers if args.verify_workers is not None \
+        else (config['verify_workers'] if "verify_workers" in config else glob['verify_workers'])
+    if glob['verify_workers'] is not None and glob['verify_workers'] < 1:
+        parser.error('The number of verify workers must be at least 1, got %s.' % glob['verify_workers'])
+
+    # Staged update related
+    glob['staged_update'] = args.staged_update if args.staged_update is True \
+        else (config['staged_update'] if "staged_update" in config else glob['staged_update'])
+    glob['live_mods_folder_path'] = glob['mods_folder_path']
+    # Stored in the live folder, whatever the staging, as it is only written once the update succeeded
+    glob['update_cursor_path'] = os.path.join(glob['mods_folder_path'], 'mods-manager-cursor.json')
+    glob['full_update'] = args.full_update
+    glob['staging_folder_path'] = glob['mods_folder_path'] + '.staging'
+    glob['previous_folder_path'] = glob['mods_folder_path'] + '.previous'
+
     # User credential related
     glob['username'] = args.username if args.username is not None \
         else (config['username'] if "username" in config else glob['username'])
@@ -665,7 +1441,7 @@ def load_config(args):
         else (config['token'] if "token" in config else glob['token'])
 
     # If we are updating OR there is a mod to install, we ensure that the username and token are set
-    if (args.should_update is True or args.mod_name_to_install is not None) and (glob['username'] is None or glob['username'] is None):
+    if (args.should_update is True or args.mod_name_to_install is not None or args.repair is True) and (glob['username'] is None or glob['username'] is None):
         parser.error('Username and/or Token not correctly set. Set them in "config.json" or by passing -u / -t arguments. See README on how to obtain them.')
 
     # Script configuration related
@@ -717,6 +1493,88 @@ def check_mod_manager_update():
         print('Cannot find "git" executable, skipping...')
 
 
+def reload_factorio():
+    if glob['has_to_reload'] is not True:
+        return
+
+    print('The mod configuration changed and Factorio need to be restarted in order to apply the changes.')
+
+    if glob['dry_run']:
+        print('Dry-running, would have%s automatically reloaded' % (" NOT" if glob['should_reload'] is False else ""))
+        return
+
+    if glob['should_reload'] is True:
+        print('Reloading service %s' % (glob['service_name']))
+        os.system('systemctl restart %s' % (glob['service_name']))
+    else:
+        print('Automatic reload has been disabled, please restart Factorio by yourself.')
+
+
+glob_profile_phases = []
+
+
+def start_profiling(args):
+    glob['profile_path'] = os.path.abspath(args.profile_path)
+    glob['profile_memory'] = args.profile_memory
+    glob['profile_top'] = args.profile_top
+
+    if glob['profile_memory']:
+        # Imported here as tracemalloc does not exist on Python 2
+        try:
+            import tracemalloc
+        except ImportError:
+            parser.error('--profile-memory needs Python 3.4 or newer.')
+        tracemalloc.start()
+
+    # Many operations exit() directly, so the profile is written whenever the script stops
+    atexit.register(write_profile)
+
+
+def run_phase(name, function, *args):
+    if glob['profile_path'] is None:
+        return function(*args)
+
+    phase = {'name': name, 'profiler': cProfile.Profile(), 'snapshot': None}
+    glob_profile_phases.append(phase)
+
+    phase['profiler'].enable()
+    try:
+        return function(*args)
+    finally:
+        phase['profiler'].disable()
+        if glob['profile_memory']:
+            import tracemalloc
+            phase['snapshot'] = tracemalloc.take_snapshot()
+
+
+def write_profile():
+    if len(glob_profile_phases) == 0:
+        return
+
+    pstats.Stats(*[phase['profiler'] for phase in glob_profile_phases]).dump_stats(glob['profile_path'])
+
+    summary_path = glob['profile_path'] + '.txt'
+    with open(summary_path, 'w') as fd:
+        previous_snapshot = None
+        for phase in glob_profile_phases:
+            fd.write('########## Operation "%s" ##########\n' % phase['name'])
+            pstats.Stats(phase['profiler'], stream=fd).sort_stats('cumulative').print_stats(glob['profile_top'])
+
+            if phase['snapshot'] is not None:
+                if previous_snapshot is None:
+                    fd.write('Top memory allocations :\n')
+                    statistics = phase['snapshot'].statistics('lineno')
+                else:
+                    fd.write('Top memory allocations (difference with the previous operation) :\n')
+                    statistics = phase['snapshot'].compare_to(previous_snapshot, 'lineno')
+                for statistic in statistics[:glob['profile_top']]:
+                    fd.write('    %s\n' % statistic)
+                fd.write('\n')
+                previous_snapshot = phase['snapshot']
+
+    print('Profile written to %s, summary written to %s' % (glob['profile_path'], summary_path))
+
+
 def main():
     if len(sys.argv) == 1:
         parser.print_help()
@@ -729,54 +1587,93 @@ def main():
         check_mod_manager_update()
         exit(0)
 
-    if not load_config(args):
+    if args.profile_path is not None:
+        start_profiling(args)
+
+    # Search the mod portal, no Factorio installation is needed for this
+    if args.search_text is not None or args.refresh_index:
+        glob['verbose'] = args.verbose
+        index = run_phase('index', get_index, args.refresh_index)
+        if not index:
+            exit(1)
+        if args.search_text is not None:
+            run_phase('search', lambda: display_search_results(index, search_index(index, args.search_text)))
+            exit(0)
+
+        # Only the index was asked to be refreshed
+        if not any((args.list_mods, args.verify, args.repair, args.rollback, args.should_update, args.mod_name_to_install,
+                    args.remove_mod_name, args.enable_mods_name, args.disable_mods_name)):
+            print('Finished !')
+            exit(0)
+
+    if not run_phase('load_config', load_config, args):
         print('Failing miserably...')
         exit(1)
 
     # List installed mods
     if args.list_mods:
-        display_mods_list(read_mods_list())
+        run_phase('list', lambda: display_mods_list(read_mods_list()))
+        exit(0)
+
+    # Verify (and repair) installed mods, meant to be run while Factorio is stopped
+    if args.verify or args.repair:
+        if not run_phase('verify', verify_mods, args.repair):
+            exit(1)
+        exit(0)
+
+    # Swap back the previous mods folder
+    if args.rollback:
+        if not run_phase('rollback', rollback_mods):
+            exit(1)
+        run_phase('reload', reload_factorio)
+        print('Finished !')
         exit(0)
 
+    # Checked against the local index before anything is changed, a refused name stops the whole run
+    if args.mod_name_to_install and not check_mod_name(args.mod_name_to_install):
+        exit(1)
+
+    # Every change below is done in the staging folder, the live one is only touched by the final swap
+    if glob['staged_update'] is True and not glob['dry_run']:
+        run_phase('prepare_staging', prepare_staging)
+
     # Enabled mods
     if args.enable_mods_name:
-        update_state_mods(args.enable_mods_name, True)
+        run_phase('enable', update_state_mods, args.enable_mods_name, True)
         print()
 
     # Disabled mods
     if args.disable_mods_name:
-        update_state_mods(args.disable_mods_name, False)
+        run_phase('disable', update_state_mods, args.disable_mods_name, False)
         print()
 
     # If we should update the mods
     if args.should_update:
-        update_mods(args.enabled_only)
+        run_phase('update', update_mods, args.enabled_only)
         print()
 
     # If there is a mod to install
     if args.mod_name_to_install:
-        install_mod(args.mod_name_to_install)
+        run_phase('install', install_mod, args.mod_name_to_install)
         print()
 
     # If there is a mod to remove
     if args.remove_mod_name:
-        remove_mod(args.remove_mod_name)
+        run_phase('remove', remove_mod, args.remove_mod_name)
         print()
 
-    write_mods_list()
+    run_phase('write_mods_list', write_mods_list)
 
-    if glob['has_to_reload'] is True:
-        print('The mod configuration changed and Factorio need to be restarted in order to apply the changes.')
+    if glob['staged_update'] is True and not glob['dry_run']:
+        if glob['has_to_reload'] is True:
+            run_phase('commit_staging', commit_staging)
+        else:
+            run_phase('discard_staging', discard_staging)
 
-        if glob['dry_run']:
-            print('Dry-running, would have%s automatically reloaded' % (" NOT" if glob['should_reload'] is False else ""))
-            return
+    if glob['pending_update_cursor'] is not None:
+        save_update_cursor()
 
-        if glob['should_reload'] is True:
-            print('Reloading service %s' % (glob['service_name']))
-            os.system('systemctl restart %s' % (glob['service_name']))
-        else:
-            print('Automatic reload has been disabled, please restart Factorio by yourself.')
+    run_phase('reload', reload_factorio)
 
     print('Finished !')
     exit(0)